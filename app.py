@@ -1,99 +1,139 @@
 import streamlit as st
 import os
-from PIL import Image, ImageDraw
-import cv2
 import numpy as np
-from pdf2image import convert_from_path
-import tempfile
+import pymupdf
 import datetime
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from image_diff import diff_page, encode_png, init_worker
+
+# 表示用の結合画像1枚あたりの高さの上限（PNGの上限 PNG_MAX_SIZE より十分小さくし、ブラウザでも扱える大きさにする）
+COMBINED_PART_MAX_HEIGHT = 20000
 
 def combine_images(images):
-    """複数の画像を縦方向に連結する関数"""
+    """複数の画像（numpy 配列）を縦方向に連結する関数"""
     # 全画像の幅と高さを取得
-    widths, heights = zip(*(i.size for i in images))
+    heights, widths = zip(*(img.shape[:2] for img in images))
     
     # 最大幅と合計の高さを計算
     max_width = max(widths)
     total_height = sum(heights)
     
-    # 新しい画像を作成
-    combined_image = Image.new('RGB', (max_width, total_height), 'white')
+    # 白で塗りつぶした連結先の配列を作成
+    combined_image = np.full((total_height, max_width, 3), 255, dtype=np.uint8)
     
     # 画像を縦に連結
     y_offset = 0
     for img in images:
         # 画像の幅が最大幅と異なる場合は、センタリング
-        x_offset = (max_width - img.size[0]) // 2
-        combined_image.paste(img, (x_offset, y_offset))
-        y_offset += img.size[1]
+        height, width = img.shape[:2]
+        x_offset = (max_width - width) // 2
+        combined_image[y_offset:y_offset + height, x_offset:x_offset + width] = img
+        y_offset += height
     
     return combined_image
 
-def highlight_differences(base_image, check_image, progress_bar=None, current_progress=0):
-    """個別の画像ページの差分を検出する関数"""
-    # 画像のリサイズ
-    min_width = min(base_image.width, check_image.width)
-    min_height = min(base_image.height, check_image.height)
-    base_image_resized = base_image.resize((min_width, min_height), Image.LANCZOS)
-    check_image_resized = check_image.resize((min_width, min_height), Image.LANCZOS)
+def process_pdfs(base_bytes, check_bytes, progress_bar, detect_width=1000, display_width=2000):
+    """全てのPDFページを処理し、処理が終わったページから順に (ページ番号, PNG, 縮小画像) を返すジェネレーター
     
-    # グレースケール変換して差分検出
-    base_gray = cv2.cvtColor(np.array(base_image_resized), cv2.COLOR_RGB2GRAY)
-    check_gray = cv2.cvtColor(np.array(check_image_resized), cv2.COLOR_RGB2GRAY)
+    差分検出は detect_width の低解像度画像で行い、結果は display_width のベース画像に重ねて出力する。
+    """
+    # ページ数の取得
+    with pymupdf.open(stream=base_bytes, filetype='pdf') as base_doc:
+        base_page_count = base_doc.page_count
+    with pymupdf.open(stream=check_bytes, filetype='pdf') as check_doc:
+        check_page_count = check_doc.page_count
     
-    # 差分計算
-    diff = cv2.absdiff(base_gray, check_gray)
-    _, diff_mask = cv2.threshold(diff, 30, 255, cv2.THRESH_BINARY)
+    total_pages = min(base_page_count, check_page_count)
+    # st.write(f"検出したページ数: {total_pages}")
+    st.write(f"ベースPDFのページ数: {base_page_count}")
+    st.write(f"チェック対象PDFのページ数: {check_page_count}")
     
-    # 画像処理
-    base_rgba = base_image_resized.convert('RGBA')
-    overlay = Image.new('RGBA', base_rgba.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
+    # 各ページの画像変換と差分検出を別プロセスで並列に処理（Streamlit 上でも安全に起動できるよう spawn を使用）
+    # PDFは各ワーカーの初期化時に1回だけ渡し、ページの画像はワーカー内で必要な分だけ作成する
+    max_workers = min(os.cpu_count() or 1, 8)
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,
+                             initargs=(base_bytes, check_bytes)) as executor:
+        pending = {}
+        next_page = 0
+        done = 0
+        try:
+            while pending or next_page < total_pages:
+                # 処理待ちのページが溜まりすぎないよう、ワーカー数の2倍までずつ投入する
+                while next_page < total_pages and len(pending) < max_workers * 2:
+                    pending[executor.submit(diff_page, next_page, detect_width, display_width)] = next_page
+                    next_page += 1
+                
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # 受け取ったページの結果はすぐに手放し、全ページ分を保持しないようにする
+                    page_index = pending.pop(future)
+                    png, preview = future.result()
+                    done += 1
+                    progress = int(10 + (80 * done / total_pages))
+                    progress_bar.progress(progress, text=f"ページ {done}/{total_pages} を処理完了...")
+                    yield page_index, png, preview
+        except BaseException:
+            # エラーや Streamlit の中断・再実行時は、残りのページを処理し終えるのを待たずに打ち切る
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def compute_diff_images(base_bytes, check_bytes, detect_width=1000, display_width=2000):
+    """アップロードされたPDFの差分を検出し、結果のZIPと表示用の画像を作成する関数（同じファイルの再実行時はキャッシュを返す）
     
-    # 差分部分に下線や枠線を追加
-    height, width = diff_mask.shape
-    for y in range(height):
-        for x in range(width):
-            if diff_mask[y, x] > 0:
-                draw.point((x, y), fill=(255, 165, 0, 120))
-                for dx, dy in [(-1,0), (1,0), (0,-1), (0,1)]:
-                    new_x, new_y = x + dx, y + dy
-                    if 0 <= new_x < width and 0 <= new_y < height:
-                        draw.point((new_x, new_y), fill=(255, 165, 0, 60))
+    戻り値は (ZIPのバイト列, 表示用の結合画像のPNGのリスト, ページ数)。
+    """
+    # プログレスバーはこの関数内で作成する（キャッシュから返す場合は、完了した状態のバーが再表示される）
+    progress_bar = st.progress(0, text="処理を開始します...")
+    progress_bar.progress(10, text="PDFの差分を検出中...")
     
-    # 画像の合成
-    background = Image.new('RGBA', base_rgba.size, (255, 255, 255, 255))
-    result = Image.alpha_composite(background, base_rgba)
-    result = Image.alpha_composite(result, overlay)
-    result = result.convert('RGB')
+    zip_buffer = io.BytesIO()
+    page_count = 0
     
-    return result
-
-def process_pdfs(base_pdf_path, check_pdf_path, progress_bar):
-    """全てのPDFページを処理する関数"""
-    # PDFを画像に変換
-    progress_bar.progress(10, text="PDFを画像に変換中...")
-    base_images = convert_from_path(base_pdf_path, size=(2000, None), fmt='png')
-    check_images = convert_from_path(check_pdf_path, size=(2000, None), fmt='png')
+    # 結合版は縮小画像を縦に連結して作るが、ページ数が多いとPNGの縦の上限を超えるため、
+    # COMBINED_PART_MAX_HEIGHT ごとに分割する。埋まった分はすぐPNGにして、縮小画像は手放す
+    combined_pngs = []
+    part_previews = []
+    part_height = 0
     
-    total_pages = min(len(base_images), len(check_images))
-    # st.write(f"検出したページ数: {total_pages}")
-    st.write(f"ベースPDFのページ数: {len(base_images)}")
-    st.write(f"チェック対象PDFのページ数: {len(check_images)}")
-    results = []
+    def flush_part():
+        if part_previews:
+            combined_pngs.append(encode_png(combine_images(part_previews)))
+            part_previews.clear()
     
-    # 各ページを処理
-    for i in range(total_pages):
-        progress = int(10 + (80 * i / total_pages))
-        progress_bar.progress(progress, text=f"ページ {i+1}/{total_pages} を処理中...")
+    # PNGは圧縮済みのため、ZIPでは再圧縮せずそのまま格納する
+    with ZipFile(zip_buffer, 'w', compression=ZIP_STORED) as zip_file:
+        # 個別ページの保存（ZIP内の並びがページ順になるよう、先に終わったページは前のページが揃うまで待たせる）
+        waiting_pages = {}
+        next_page = 0
+        for i, png, preview in process_pdfs(base_bytes, check_bytes, progress_bar, detect_width, display_width):
+            waiting_pages[i] = (png, preview)
+            while next_page in waiting_pages:
+                png, preview = waiting_pages.pop(next_page)
+                zip_file.writestr(f'diff_result_page_{next_page+1}.png', png)
+                if part_height + preview.shape[0] > COMBINED_PART_MAX_HEIGHT:
+                    flush_part()
+                    part_height = 0
+                part_previews.append(preview)
+                part_height += preview.shape[0]
+                next_page += 1
+                page_count += 1
+        flush_part()
         
-        result_image = highlight_differences(base_images[i], check_images[i])
-        results.append(result_image)
+        # 結合版の保存（縮小画像を連結したプレビュー版。分割した場合は連番を付ける）
+        if len(combined_pngs) == 1:
+            zip_file.writestr('diff_result_combined_preview.png', combined_pngs[0])
+        else:
+            for n, combined_png in enumerate(combined_pngs, start=1):
+                zip_file.writestr(f'diff_result_combined_preview_{n}.png', combined_png)
     
     progress_bar.progress(100, text="完了！")
-    return results
+    return zip_buffer.getvalue(), combined_pngs, page_count
 
 def main():
     st.title("PDF比較ツール(複数ページ対応)")
@@ -106,55 +146,27 @@ def main():
     if st.button("差分を検出"):
         if base_file and check_file:
             try:
-                # プログレスバーの初期化
-                progress_bar = st.progress(0, text="処理を開始します...")
-                
-                # 一時ファイルとして保存
-                progress_bar.progress(5, text="ファイルを準備中...")
-                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_base:
-                    tmp_base.write(base_file.getvalue())
-                    base_path = tmp_base.name
-                    
-                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_check:
-                    tmp_check.write(check_file.getvalue())
-                    check_path = tmp_check.name
-                
-                # 差分検出実行
-                result_images = process_pdfs(base_path, check_path, progress_bar)
-                
-                # 一時ファイルの削除
-                os.unlink(base_path)
-                os.unlink(check_path)
+                # 差分検出実行（プログレスバーは compute_diff_images 内で表示する）
+                zip_data, combined_pngs, page_count = compute_diff_images(base_file.getvalue(), check_file.getvalue())
                 
                 # 結果の表示（単一画像として）
                 st.subheader("差分検出結果")
-                combined_image = combine_images(result_images)
-                st.image(combined_image, caption="全ページの差分検出結果", use_column_width=True)
+                if len(combined_pngs) == 1:
+                    captions = ["全ページの差分検出結果"]
+                else:
+                    captions = [f"全ページの差分検出結果 ({n}/{len(combined_pngs)})" for n in range(1, len(combined_pngs) + 1)]
+                st.image(combined_pngs, caption=captions, use_column_width=True)
                 
-                # ZIPファイルの作成（個別ページと結合版の両方を含める）
+                # ダウンロードボタン（ZIPには元の解像度の個別ページと、縮小した結合版の両方を含める）
                 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                zip_buffer = io.BytesIO()
-                with ZipFile(zip_buffer, 'w') as zip_file:
-                    # 結合版の保存
-                    combined_buffer = io.BytesIO()
-                    combined_image.save(combined_buffer, format='PNG')
-                    zip_file.writestr('diff_result_combined.png', combined_buffer.getvalue())
-                    
-                    # 個別ページの保存
-                    for i, img in enumerate(result_images):
-                        img_buffer = io.BytesIO()
-                        img.save(img_buffer, format='PNG')
-                        zip_file.writestr(f'diff_result_page_{i+1}.png', img_buffer.getvalue())
-                
-                # ダウンロードボタン
                 st.download_button(
                     label="結果をダウンロード (ZIP)",
-                    data=zip_buffer.getvalue(),
+                    data=zip_data,
                     file_name=f"diff_results_{timestamp}.zip",
                     mime="application/zip"
                 )
                 
-                st.success(f"処理が完了しました！全 {len(result_images)} ページの処理が終了しました。")
+                st.success(f"処理が完了しました！全 {page_count} ページの処理が終了しました。")
                 
             except Exception as e:
                 st.error(f"エラーが発生しました: {str(e)}")
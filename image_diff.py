@@ -0,0 +1,178 @@
+import os
+import cv2
+import numpy as np
+import pymupdf
+
+# OpenCV の最適化処理（SIMD）を有効にし、スレッド数はプロセスプールと取り合わないよう半分に抑える
+cv2.setUseOptimized(True)
+cv2.setNumThreads(max(1, (os.cpu_count() or 1) // 2))
+
+# 縁取りと合成を1回の走査で行う numba 版を標準で使う（numba が使えない環境では OpenCV 版で処理する）
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# ワーカープロセスごとに1回だけ開いて使い回すPDF（PyMuPDF はスレッド間で共有できないためプロセスごとに持つ）
+_documents = {}
+
+def init_worker(base_bytes, check_bytes):
+    """プロセスプールのワーカー初期化関数
+    
+    比較する2つのPDFを開いておく。並列実行中のスレッドの過剰な生成を避けるため、OpenCV は1スレッドにする。
+    """
+    cv2.setNumThreads(1)
+    _documents['base'] = pymupdf.open(stream=base_bytes, filetype='pdf')
+    _documents['check'] = pymupdf.open(stream=check_bytes, filetype='pdf')
+
+def render_page(doc, page_index, page_width):
+    """PDFの1ページを指定した幅のRGB画像（numpy 配列）に変換する関数"""
+    page = doc.load_page(page_index)
+    zoom = page_width / page.rect.width
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csRGB, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+
+def diff_page(page_index, detect_width, display_width):
+    """ワーカープロセスで1ページ分の画像変換と差分検出を行う関数
+    
+    差分検出は detect_width の低解像度画像で行い、結果は display_width のベース画像に重ねて出力する。
+    """
+    base_doc = _documents['base']
+    check_doc = _documents['check']
+    result = highlight_differences(render_page(base_doc, page_index, detect_width),
+                                   render_page(check_doc, page_index, detect_width),
+                                   render_page(base_doc, page_index, display_width))
+    
+    # 元の解像度の画像はワーカー内でPNGに変換し、メインプロセスにはPNGと縮小画像だけを返す
+    return encode_png(result), make_preview(result)
+
+def make_preview(image, preview_width=1200):
+    """画面表示用に画像を指定幅まで縮小する関数（元の幅以下の場合はそのまま返す）"""
+    height, width = image.shape[:2]
+    if width <= preview_width:
+        return image
+    preview_height = max(1, round(height * preview_width / width))
+    return cv2.resize(image, (preview_width, preview_height), interpolation=cv2.INTER_AREA)
+
+def resize_image(image_arr, width, height):
+    """画像を指定サイズにリサイズする関数（既に同じサイズならそのまま返す）"""
+    if image_arr.shape[:2] == (height, width):
+        return image_arr
+    return cv2.resize(image_arr, (width, height), interpolation=cv2.INTER_AREA)
+
+def highlight_differences(base_arr, check_arr, display_arr=None):
+    """個別の画像ページの差分を検出する関数（プロセス間で受け渡せるよう numpy 配列で入出力する）
+    
+    display_arr を渡した場合は、差分マスクをそのサイズに拡大して display_arr 上に描画する。
+    """
+    # 画像のリサイズ（同じ設定で変換したページは通常同じサイズなので、その場合は省略する）
+    min_height = min(base_arr.shape[0], check_arr.shape[0])
+    min_width = min(base_arr.shape[1], check_arr.shape[1])
+    base_resized = resize_image(base_arr, min_width, min_height)
+    check_resized = resize_image(check_arr, min_width, min_height)
+    
+    # 差分計算（グレースケール変換を挟まず、いずれかの色チャンネルの差が閾値を超えた画素を差分とする）
+    diff = cv2.absdiff(base_resized, check_resized).max(axis=2)
+    _, diff_mask = cv2.threshold(diff, 30, 255, cv2.THRESH_BINARY)
+    
+    # 表示用の高解像度画像が渡された場合は、差分マスクだけを拡大して重ねる
+    if display_arr is not None:
+        base_resized = display_arr
+    
+    # 差分が無いページはハイライト処理を省略してそのまま返す
+    if cv2.countNonZero(diff_mask) == 0:
+        return base_resized
+    
+    if display_arr is not None:
+        display_height, display_width = display_arr.shape[:2]
+        diff_mask = cv2.resize(diff_mask, (display_width, display_height), interpolation=cv2.INTER_NEAREST)
+    
+    # 差分を含む範囲（縁取りの1ピクセル分を含む）だけを切り出して合成する
+    height, width = diff_mask.shape
+    x, y, w, h = cv2.boundingRect(diff_mask)
+    x0, y0 = max(x - 1, 0), max(y - 1, 0)
+    x1, y1 = min(x + w + 1, width), min(y + h + 1, height)
+    
+    # 出力は不透明なRGB画像なので、RGBAへの変換はせずRGBのまま合成する
+    rgb = base_resized[y0:y1, x0:x1]
+    mask = diff_mask[y0:y1, x0:x1]
+    result = base_resized.copy()
+    if njit is not None:
+        # numba 版は膨張処理と合成を1回の走査にまとめるため、OpenCV版よりメモリの読み書きが少ない
+        blend_overlay_jit(np.ascontiguousarray(rgb), np.ascontiguousarray(mask), result[y0:y1, x0:x1])
+    else:
+        result[y0:y1, x0:x1] = blend_overlay(rgb, mask)
+    
+    return result
+
+def blend_overlay(rgb, diff_mask):
+    """差分マスクの部分をオレンジでハイライトした画像を作成する関数"""
+    # 差分部分の周囲1ピクセル（上下左右）を縁取りとして求める
+    kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+    halo = cv2.dilate(diff_mask, kernel)
+    
+    # 差分部分に下線や枠線を追加（縁取りは薄く、差分本体は濃く塗る）
+    height, width = diff_mask.shape
+    alpha = get_scratch('alpha', (height, width, 1), np.uint16)
+    alpha.fill(0)
+    alpha[halo > 0] = 60
+    alpha[diff_mask > 0] = 120
+    
+    # 画像の合成（背景は不透明な白なので、ベース画像にオレンジを直接ブレンドする）
+    orange = np.array([255, 165, 0], dtype=np.uint16)
+    result = get_scratch('result', (height, width, 3), np.uint16)
+    weighted = get_scratch('weighted', (height, width, 3), np.uint16)
+    np.subtract(255, alpha, out=result)
+    result *= rgb
+    np.multiply(orange, alpha, out=weighted)
+    result += weighted
+    result //= 255
+    
+    return result.astype(np.uint8)
+
+# ワーカープロセス内でページをまたいで使い回す作業用バッファ
+_scratch_buffers = {}
+
+def get_scratch(name, shape, dtype):
+    """作業用バッファを取得する関数（ページごとに新しくメモリを確保しないよう、確保済みの領域を再利用する）"""
+    size = int(np.prod(shape))
+    buffer = _scratch_buffers.get(name)
+    if buffer is None or buffer.dtype != dtype or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        _scratch_buffers[name] = buffer
+    return buffer[:size].reshape(shape)
+
+if njit is not None:
+    @njit(cache=True)
+    def blend_overlay_jit(rgb, diff_mask, out):
+        """blend_overlay の numba 版（縁取りの判定と合成を1回の走査でまとめて行う）"""
+        height, width = diff_mask.shape
+        orange = (255, 165, 0)
+        for y in range(height):
+            for x in range(width):
+                if diff_mask[y, x] > 0:
+                    alpha = 120
+                elif ((y > 0 and diff_mask[y - 1, x] > 0) or
+                      (y < height - 1 and diff_mask[y + 1, x] > 0) or
+                      (x > 0 and diff_mask[y, x - 1] > 0) or
+                      (x < width - 1 and diff_mask[y, x + 1] > 0)):
+                    alpha = 60
+                else:
+                    alpha = 0
+                for c in range(3):
+                    out[y, x, c] = (rgb[y, x, c] * (255 - alpha) + orange[c] * alpha) // 255
+
+# libpng（cv2.imencode）で書き出せる画像の縦横の最大ピクセル数
+PNG_MAX_SIZE = 1_000_000
+
+def encode_png(image_arr):
+    """RGB画像をPNG形式のバイト列に変換する関数（縦横とも PNG_MAX_SIZE 以下の画像のみ変換できる）"""
+    height, width = image_arr.shape[:2]
+    if height > PNG_MAX_SIZE or width > PNG_MAX_SIZE:
+        raise ValueError(f"PNG形式に変換できる画像の大きさ（縦横 {PNG_MAX_SIZE} ピクセル）を超えています: {width}x{height}")
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 6,
+              cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_FILTERED]
+    ok, png = cv2.imencode('.png', cv2.cvtColor(image_arr, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise ValueError("PNG形式への変換に失敗しました")
+    return png.tobytes()